@@ -0,0 +1 @@
+# Lets pytest import the `src` package when run from the repository root.
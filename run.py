@@ -43,6 +43,10 @@ def main(targets):
     # to show up in standard out.
     logging.getLogger().addHandler(logging.StreamHandler())
 
+    # Numba logs its compiler internals at DEBUG whenever a kernel is compiled,
+    # which would otherwise flood the logs on a fresh checkout.
+    logging.getLogger('numba').setLevel(logging.WARNING)
+
     if 'all' in targets or len(targets) == 0:
         run_all = True
 
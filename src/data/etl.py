@@ -58,28 +58,36 @@ def clean(df):
 def unbin(df):
     """
     Takes in a DataFrame formatted as a network-stats output and 'unbins' the
-    packet-level measurements so that each packet gets its own row.
+    packet-level measurements so that each packet gets its own entry.
+
+    Returns the packet times, sizes, and directions as three aligned arrays.
     """
     
     packet_cols = ['packet_times', 'packet_sizes', 'packet_dirs']
     
-    # Convert the strings `val1;val2;` into lists `[val1, val2]`
-    df_listed = (
-        df[packet_cols]
-        .apply(lambda ser: ser.str.split(';').str[:-1])
-    )
-    
-    # 'Explode' the lists so each element gets its own row.
+    # Each cell is a string `val1;val2;` with a trailing separator, so joining
+    # a whole column end-to-end gives one long `;`-delimited string.
     #
-    # Exploding is considerably faster than summing lists and creating a new
-    # frame.
-    unbinned = (
-        df_listed
-        # Each list contains integer values, so we'll also cast them now.
-        .apply(lambda ser: ser.explode(ignore_index=True).astype(int))
-    )
-    
-    return unbinned   
+    # Parsing that string in a single NumPy call is considerably faster than
+    # splitting and exploding the column row by row.
+    #
+    # Joining skips missing cells and parsing stops early at a malformed value,
+    # either of which would misalign packets across the three columns, so both
+    # are checked for rather than silently pairing the wrong values.
+    if df[packet_cols].isna().any().any():
+        raise ValueError('Packet measurements are missing from some rows.')
+
+    unbinned = []
+    for col in packet_cols:
+        parsed = np.fromstring(df[col].str.cat(), dtype=np.int64, sep=';')
+        if len(parsed) != df[col].str.count(';').sum():
+            raise ValueError(f'Malformed packet measurements in `{col}`.')
+        unbinned.append(parsed)
+
+    if len({len(parsed) for parsed in unbinned}) > 1:
+        raise ValueError('Packet measurement columns differ in length.')
+
+    return tuple(unbinned)
 
 
 def _process_file(args):
@@ -107,16 +115,24 @@ def process_file(filepath, out_dir):
     df = clean(df)
 
     # Extract packet-level data
-    df = unbin(df)
-    
-    # Set the index to timedelta (should be monotonic increasing)
-    df.columns = ['time', 'size', 'dir'] # NOTE: Renaming to match existing code
-    df = df.sort_values('time')
-    df['dt_time'] = pd.to_timedelta(df.time - df.time[0], PACKET_TIMESTAMP_UNIT)
-    df = df.set_index('dt_time')
-
-    # Finally, save the preprocessed file.
-    df.to_csv(pathlib.Path(out_dir, 'preprocessed-'+filepath.name))
+    times, sizes, dirs = unbin(df)
+
+    # Order packets by time (should be monotonic increasing)
+    order = np.argsort(times, kind='stable')
+    times, sizes, dirs = times[order], sizes[order], dirs[order].astype(np.int8)
+
+    # NOTE: Column names match existing code
+    df = pd.DataFrame({'time': times, 'size': sizes, 'dir': dirs})
+
+    # Finally, save the preprocessed file. Parquet keeps the integer dtypes
+    # and is far quicker to read back than CSV.
+    #
+    # No time offset index is stored: feature engineering derives offsets
+    # from `time` directly.
+    df.to_parquet(
+        pathlib.Path(out_dir, 'preprocessed-'+filepath.stem+'.parquet'),
+        engine='pyarrow', compression='snappy', index=False
+    )
 
     return True
 
@@ -1,10 +1,17 @@
 import pandas as pd
 import numpy as np
 import re
+from functools import lru_cache
+import scipy
+from scipy.signal import peak_prominences
+
+from numba import njit
 
 def split(filename, chunk_size):
     """
-    Splits each dataset into chunk_size chunks
+    Splits each dataset into chunk_size chunks. Returns the dataset's label,
+    its packet times, sizes, and directions as arrays, and the (start, stop)
+    bounds of each chunk within those arrays.
     """
 
     # On uncleaned filenames:
@@ -23,42 +30,157 @@ def split(filename, chunk_size):
         raise Exception(f'Filename {filename} unclear.')
 
 
-    df = pd.read_csv(filename)
-    start = df['time'].values[0]-1
-    end = df['time'].values[-1]+chunk_size
+    # Only the packet columns are needed; chunk offsets are taken from `time`.
+    df = pd.read_parquet(
+        filename, engine='pyarrow', columns=['time', 'size', 'dir'],
+        use_threads=True
+    )
+    times = df['time'].to_numpy(np.int64)
+    sizes = df['size'].to_numpy(np.int64)
+    dirs = df['dir'].to_numpy(np.int8)
+    start = times[0]-1
+    end = times[-1]+chunk_size
     bins = np.arange(start, end, chunk_size)
-    df['binned'] = pd.cut(df['time'], bins)
-    all_dfs = []
-    for key, split_df in df.groupby('binned'):
-        all_dfs.append((int(is_streaming), split_df))
-    return all_dfs
+
+    # Packets are sorted by time, so the boundaries of each (left, right] bin
+    # can be found with a binary search and each chunk taken as a slice,
+    # rather than labelling every row and grouping on those labels.
+    edges = np.searchsorted(times, bins, side='right')
+
+    # Chunks without any received bytes (so also any received packets) have
+    # no features, and chunks need at least two packets for an interpacket
+    # delay and a resampled signal. These are dropped here rather than being
+    # dispatched to a worker.
+    received_bytes = np.r_[0, np.cumsum(sizes * (dirs == 2))]
+    viable = (
+        (received_bytes[edges[1:]] > received_bytes[edges[:-1]])
+        & (edges[1:] - edges[:-1] >= 2)
+    )
+    chunks = [
+        (lo, hi)
+        for lo, hi, keep in zip(edges[:-1], edges[1:], viable)
+        if keep
+    ]
+    return int(is_streaming), (times, sizes, dirs), chunks
 
 #Streaming longest streak of direction 1 and 2 packets
 def longest_dir_streak(vals, dir):
     """
     Finds the longest streak of direction 1 or 2 packets.
+
+    `dir` may also be a sequence of directions, in which case the longest
+    streak for each of them is found from a single run-length pass.
     """
-    longest = 0
-    current = 0
-    for num in vals:
-        if num == dir:
-            current += 1
-        else:
-            longest = max(longest, current)
-            current = 0
+    vals = np.asarray(vals)
+    dirs = np.atleast_1d(dir)
+
+    if len(vals) == 0:
+        streaks = np.zeros(len(dirs), dtype=np.int64)
+    else:
+        # Every index where the direction changes begins a new streak
+        starts = np.flatnonzero(np.r_[True, vals[1:] != vals[:-1]])
+        lengths = np.diff(np.r_[starts, len(vals)])
+        run_dirs = vals[starts]
+        streaks = np.array([lengths[run_dirs == d].max(initial=0) for d in dirs])
 
-    return max(longest, current)
+    return streaks if np.ndim(dir) else streaks[0]
 
 
-def roll(df, column, seconds, stats=['mean']):
+@njit(cache=True, nogil=True)
+def flow_stats(size, dir):
     """
-    Rolling window aggregates calculated over a specified column, time range, and aggregating stat.
+    Tallies byte sums, packet counts, and large/small packet counts for each
+    direction in a single pass over the packets.
+
+    A large packet is any packet over 1200 bytes, a small packet is any packet
+    under 200 bytes.
     """
-    window_width = pd.offsets.Second(seconds)
+    sent_bytes = received_bytes = 0
+    sent_packets = received_packets = 0
+    sent_large = sent_small = received_large = received_small = 0
+
+    for i in range(len(size)):
+        packet_size = size[i]
+        packet_dir = dir[i]
+
+        if packet_dir == 1:
+            sent_bytes += packet_size
+            sent_packets += 1
+            if packet_size > 1200:
+                sent_large += 1
+            elif packet_size < 200:
+                sent_small += 1
+        elif packet_dir == 2:
+            received_bytes += packet_size
+            received_packets += 1
+            if packet_size > 1200:
+                received_large += 1
+            elif packet_size < 200:
+                received_small += 1
 
     return (
-        df
-        [column]
-        .rolling(seconds)
-        .agg(stats)
+        sent_bytes, received_bytes, sent_packets, received_packets,
+        sent_large, sent_small, received_large, received_small
     )
+
+
+@njit(cache=True, nogil=True)
+def mean_rolling_delay(times, window):
+    """
+    Mean of the rolling means of interpacket delay (in milliseconds) over
+    windows of `window` consecutive delays.
+
+    The delays summed over a window telescope to the time elapsed across it,
+    so each window sum is a single subtraction of integer packet times and
+    the delays are never materialized. Sums are kept in integer milliseconds
+    and only divided once at the end.
+    """
+    windows = len(times) - window
+    if window < 1 or windows < 1:
+        return np.nan
+
+    total = 0
+    for i in range(windows):
+        total += times[i + window] - times[i]
+
+    return total / (window * windows)
+
+
+# Welch's method splits signals into segments of at most this many samples
+WELCH_NPERSEG = 256
+
+@lru_cache(maxsize=None)
+def welch_window(nperseg):
+    """
+    Hann window applied to each segment of length nperseg by Welch's method.
+    Cached since signals of the same duration share a segment length.
+    """
+    return scipy.signal.get_window('hann', nperseg)
+
+
+def max_frequency_prominences(signals, frequency):
+    """
+    Finds the largest peak prominence in the power spectral density of each
+    signal, estimated using Welch's method.
+
+    Signals of the same length are stacked and estimated in a single `welch`
+    call so that they share one batched FFT rather than one call per signal.
+    """
+    max_proms = np.zeros(len(signals))
+    lengths = np.array([len(signal) for signal in signals])
+
+    for length in np.unique(lengths):
+        rows = np.flatnonzero(lengths == length)
+        stacked = np.vstack([signals[i] for i in rows])
+        window = welch_window(min(length, WELCH_NPERSEG))
+        f, Pxx_den = scipy.signal.welch(
+            stacked, fs = frequency, window=window, nperseg=len(window),
+            axis=-1
+        )
+
+        for i, psd in zip(rows, np.sqrt(Pxx_den)):
+            peaks, _ = scipy.signal.find_peaks(psd)
+            prominences = peak_prominences(psd, peaks)[0]
+            max_proms[i] = prominences.max(initial=0)
+
+    return max_proms
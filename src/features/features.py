@@ -1,51 +1,66 @@
 import pandas as pd
 import glob
 import os
-import itertools
+import tempfile
 import numpy as np
 import scipy
-from scipy.signal import peak_prominences
-import warnings
-warnings.filterwarnings("ignore")
+import scipy.fft
 
 from src.features.feature_creation import split
-from src.features.feature_creation import roll
+from src.features.feature_creation import flow_stats
 from src.features.feature_creation import longest_dir_streak
+from src.features.feature_creation import mean_rolling_delay
+from src.features.feature_creation import max_frequency_prominences
+
+# pyFFTW is optional. When it's available, Welch's method (our only FFT user)
+# runs on FFTW with plans cached across chunks; otherwise scipy's own pocketfft
+# backend is used.
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+else:
+    scipy.fft.set_global_backend(pyfftw.interfaces.scipy_fft)
+    pyfftw.interfaces.cache.enable()
 
 import multiprocessing
+import joblib
+from joblib import Parallel, delayed
 import time
 
 import logging
 
 from src.utils import ensure_path_exists
 
-def _engineer_features(args):
-    return engineer_features(*args)
-    
-def engineer_features(
-    df, label, rolling_window_1, rolling_window_2, resample_rate,
-    frequency
-    ):
+# Chunks are engineered on threads since the numeric kernels release the GIL.
+# Setting FEATURES_PREFER=processes falls back to worker processes for the
+# parts which still hold it (e.g. the Python code around the kernels).
+PREFER = os.environ.get('FEATURES_PREFER', 'threads')
 
-    df['dt_time'] = pd.to_timedelta(df['dt_time'])
-    df = df.set_index('dt_time')
-    df = df.drop(columns=['binned'])
+def _engineer_chunk(i, packets, start, stop, label, params):
+    """
+    Helper to engineer features for the i-th chunk, between start and stop of
+    the shared packet arrays, using the params shared by every chunk. Returns
+    i along with the features so results can arrive in any order.
+    """
+    times, sizes, dirs = (np.asarray(arr[start:stop]) for arr in packets)
+    return i, engineer_features(times, sizes, dirs, label, *params)
 
-    #drop rows with any nan
-    df = df.dropna(how='any')
+def engineer_features(
+    times, sizes, dirs, label, rolling_window_1, rolling_window_2, resample_step
+    ):
 
     #flow level statistics
-    sent_bytes = df[df['dir'] == 1]['size'].sum()
-    received_bytes = df[df['dir'] == 2]['size'].sum()
-    sent_packets = len(df[df['dir'] == 1])
-    received_packets = len(df[df['dir'] == 2])
-
-    #if there are no received bytes or packets, skip this chunk
-    if received_bytes == 0 or received_packets == 0:
-        return
+    (
+        sent_bytes, received_bytes, sent_packets, received_packets,
+        sent_large, sent_small, received_large, received_small
+    ) = flow_stats(sizes, dirs)
 
-    received_mean_size = df.loc[df.dir==2, 'size'].mean()
-    sent_mean_size = df.loc[df.dir==1, 'size'].mean()
+    #a chunk may have no sent packets, in which case their mean size and
+    #proportions are 0 rather than a division by zero
+    received_mean_size = received_bytes / received_packets
+    sent_mean_size = sent_bytes / sent_packets if sent_packets else 0.0
 
     #ratio of sent bytes over received bytes
     bytes_ratio = sent_bytes / received_bytes
@@ -56,44 +71,36 @@ def engineer_features(
     #ratios
     #large packet is defined as any packet size over 1200 byes
     #small packet is defined as any packet under 200 bytes
-    sent_large = df[(df['dir']==1) & (df['size'] > 1200)]
-    sent_small = df[(df['dir']==1) & (df['size'] < 200)]
-    received_large = df[(df['dir']==2) & (df['size'] > 1200)]
-    received_small = df[(df['dir']==2) & (df['size'] < 200)]
-    
+    #
     #ratio of large, uploaded packets over all uploaded packets 
-    sent_large_prop = len(sent_large) / len(df[(df['dir']==1)])
+    sent_large_prop = sent_large / sent_packets if sent_packets else 0.0
     #ratio of small, uploaded packets over all uploaded packets
-    sent_small_prop = len(sent_small) / len(df[(df['dir']==1)])
+    sent_small_prop = sent_small / sent_packets if sent_packets else 0.0
     #ratio of large, downloaded packets over all downloaded packets
-    received_large_prop = len(received_large) / len(df[(df['dir']==2)])
+    received_large_prop = received_large / received_packets
     #ratio of small, downloaded packets over all downloaded packets
-    received_small_prop = len(received_small) / len(df[(df['dir']==2)])
+    received_small_prop = received_small / received_packets
     
-    
-    #interpacket delay
-    df['ip_delay'] = df.index.to_series().diff().dt.total_seconds() * 1000
-    df = df.dropna(how='any')
-
-    #signal peak prominence using welch's method
-    df_rs = df.resample(resample_rate).sum()
-    f, Pxx_den = scipy.signal.welch(df_rs['size'], fs = frequency)
-    peaks, _ = scipy.signal.find_peaks(np.sqrt(Pxx_den))
-    prominences = peak_prominences(np.sqrt(Pxx_den), peaks)[0]
-    try:
-        df_max_prom = prominences.max()
-    except:
-        df_max_prom = 0
+    #resampled signal, whose peak prominence using welch's method is found
+    #for all chunks at once after the features are engineered
+    #
+    #the first packet has no interpacket delay, so the resampled signal starts
+    #from the second packet. like resampling a timedelta index, bins of
+    #resample_step milliseconds are anchored at that packet's time.
+    bins = (times[1:] - times[1]) // resample_step
+    size_rs = np.bincount(bins, weights=sizes[1:])
     
     #interpacket delay means over rolling windows of 10 seconds and 60 seconds
     #
     #need to convert milliseconds to seconds here
-    rolling_delays_10 = roll(df, 'ip_delay', int(rolling_window_1/1000))['mean'].mean()
-    rolling_delays_60 = roll(df, 'ip_delay', int(rolling_window_2/1000))['mean'].mean()
-    
+    rolling_delays_10 = mean_rolling_delay(times, int(rolling_window_1/1000))
+    rolling_delays_60 = mean_rolling_delay(times, int(rolling_window_2/1000))
+
     #longest streaks
-    streak_sent = longest_dir_streak(df['dir'], 1)
-    streak_received = longest_dir_streak(df['dir'], 2)
+    #
+    #like the resampled signal, these start from the second packet since the
+    #first has no interpacket delay
+    streak_sent, streak_received = longest_dir_streak(dirs[1:], (1, 2))
     
     features = [bytes_ratio,
                 count_ratio,
@@ -107,12 +114,11 @@ def engineer_features(
                 received_small_prop,
                 streak_sent,
                 streak_received,
-                df_max_prom,
                 
                 label
             ]
 
-    return features
+    return features, size_rs
 
 def create_features(source_dir, out_dir, out_file, chunk_size, rolling_window_1, rolling_window_2, resample_rate, frequency):
 
@@ -120,19 +126,49 @@ def create_features(source_dir, out_dir, out_file, chunk_size, rolling_window_1,
     ensure_path_exists(source_dir, is_dir=True)
     ensure_path_exists(out_dir, is_dir=True)
 
+    #resample rate is a time offset, but packet times are in milliseconds, so
+    #it has to be a whole number of them
+    resample_step, remainder = divmod(
+        pd.Timedelta(resample_rate), pd.Timedelta(1, unit='ms')
+    )
+    if resample_step < 1 or remainder:
+        raise ValueError(
+            f'Resample rate {resample_rate} is not a whole number of '
+            'milliseconds.'
+        )
+
+    workers = multiprocessing.cpu_count()
+    # print(f'Starting a processing pool of {workers} workers.')
+    logging.info(f'Starting a pool of {workers} workers preferring {PREFER}.')
+    start = time.time()
+
     #splitting dataframe into chunk_size'd chunks
     #chunk size is in milliseconds
-    preprocessed_dfs = glob.glob(os.path.join(source_dir, 'preprocessed*'))
-    split_df_groups = [split(f, chunk_size) for f in preprocessed_dfs]
-    
-    #flattening list
-    merged = list(itertools.chain.from_iterable(split_df_groups))
-    
-    #0s and 1s indicating whether or not streaming is occurring
-    merged_keys = [m[0] for m in merged]
-    
-    #the actual dataframes
-    merged_dfs = [m[1] for m in merged]
+    #
+    #files are read and split in parallel too, so the pool is busy from the
+    #start rather than waiting on every file to be split one at a time
+    preprocessed_dfs = glob.glob(os.path.join(source_dir, 'preprocessed*.parquet'))
+    splits = Parallel(n_jobs=workers, prefer=PREFER)(
+        delayed(split)(f, chunk_size) for f in preprocessed_dfs
+    )
+
+    #the packets of every file are concatenated into three arrays shared by all
+    #workers, so a chunk is only its bounds within them and its label, 0 or 1
+    #indicating whether or not streaming is occurring
+    packets = tuple(
+        np.concatenate(columns)
+        for columns in zip(*[arrays for _, arrays, _ in splits])
+    )
+    offsets = np.cumsum([0] + [len(arrays[0]) for _, arrays, _ in splits])
+    chunks = [
+        (offset + lo, offset + hi, label)
+        for (label, _, bounds), offset in zip(splits, offsets)
+        for lo, hi in bounds
+    ]
+
+    #the per-file arrays have all been copied into packets, so release them
+    #rather than holding the dataset in memory twice
+    del splits
     cols = [
         'bytes_sr_ratio',
         'count_sr_ratio',
@@ -152,22 +188,52 @@ def create_features(source_dir, out_dir, out_file, chunk_size, rolling_window_1,
     ]
 
 
-    args = [
-        (merged_dfs[i], merged_keys[i], rolling_window_1,
-        rolling_window_2, resample_rate, frequency)
-        for i in range(len(merged_dfs))
-    ]
-
-    workers = multiprocessing.cpu_count()
-    # print(f'Starting a processing pool of {workers} workers.')
-    logging.info(f'Starting a processing pool of {workers} workers.')
-    start = time.time()
-    pool = multiprocessing.Pool(processes=workers)
-    results = pool.map(_engineer_features, args)
+    #parameters shared by every chunk are bundled into a single object once.
+    #threads share it outright, and since joblib pickles a whole batch of tasks
+    #at a time, worker processes receive it once per batch rather than once
+    #per chunk.
+    params = (rolling_window_1, rolling_window_2, resample_step)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if PREFER == 'processes':
+            #worker processes memory-map the packet arrays from a file, which
+            #joblib passes by reference rather than pickling each chunk
+            packets_file = os.path.join(temp_dir, 'packets.pkl')
+            joblib.dump(packets, packets_file)
+            packets = joblib.load(packets_file, mmap_mode='r')
+
+        #dispatching the chunks with the most packets first keeps a long chunk
+        #from being left running after every other worker has gone idle
+        longest_first = sorted(
+            range(len(chunks)), key=lambda i: chunks[i][0] - chunks[i][1]
+        )
+
+        #threads share the packet arrays outright, and automatic batching
+        #coalesces short chunks to cut dispatch overhead
+        results = Parallel(
+            n_jobs=workers, prefer=PREFER, batch_size='auto',
+            return_as='generator_unordered'
+        )(
+            delayed(_engineer_chunk)(i, packets, *chunks[i], params)
+            for i in longest_first
+        )
+
+        #each chunk's features are written straight into its row as results
+        #stream back, rather than stacking a list of rows at the end
+        #
+        #chunks without features were already dropped by split, so every
+        #row gets written
+        features = np.empty((len(chunks), len(cols)))
+        signals = [None] * len(chunks)
+        for i, (row, signal) in results:
+            signals[i] = signal
+            #the prominence, the last feature before the label, is found
+            #once every chunk's signal is available
+            features[i, :-2], features[i, -1] = row[:-1], row[-1]
     # print(f'Time elapsed: {round(time.time() - start)} seconds.')
     logging.info(f'Time elapsed: {round(time.time() - start)} seconds.')
-    
-    features = np.vstack(list(filter(lambda x: x is not None, results)))
+
+    features[:, -2] = max_frequency_prominences(signals, frequency)
 
     features_df = pd.DataFrame(features, columns=cols).dropna()
     # print(f'{features_df.shape[0]} chunks of data feature engineered.')
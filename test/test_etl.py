@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.etl import unbin
+
+
+def network_stats(times, sizes, dirs):
+    return pd.DataFrame({
+        'packet_times': times, 'packet_sizes': sizes, 'packet_dirs': dirs
+    })
+
+
+def test_unbin():
+    df = network_stats(['1;2;', '5;'], ['100;200;', '300;'], ['1;2;', '2;'])
+
+    times, sizes, dirs = unbin(df)
+
+    np.testing.assert_array_equal(times, [1, 2, 5])
+    np.testing.assert_array_equal(sizes, [100, 200, 300])
+    np.testing.assert_array_equal(dirs, [1, 2, 2])
+
+
+@pytest.mark.parametrize('times, sizes, dirs', [
+    # A missing cell
+    (['1;2;', np.nan, '5;'], ['1;2;', '3;', '4;'], ['1;2;', '1;', '2;']),
+    # A malformed value, e.g. a row cut off mid-write
+    (['1;2;', '5;'], ['1;2x;', '3;'], ['1;2;', '2;']),
+    # Rows whose columns disagree on the number of packets
+    (['1;2;', '5;'], ['1;2;', '3;4;'], ['1;2;', '2;']),
+])
+def test_unbin_rejects_misaligned_packets(times, sizes, dirs):
+    with pytest.raises(ValueError):
+        unbin(network_stats(times, sizes, dirs))
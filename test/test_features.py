@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.signal
+from scipy.signal import peak_prominences
+
+from src.features.features import create_features
+from src.features.features import engineer_features
+from src.features.feature_creation import max_frequency_prominences
+from src.features.feature_creation import split
+
+
+def baseline_features(
+    times, sizes, dirs, rolling_window_1, rolling_window_2, resample_rate,
+    frequency
+    ):
+    """
+    The original pandas implementation of the per-chunk features, kept as a
+    reference that the optimized pipeline must reproduce.
+    """
+    df = pd.DataFrame(
+        {'size': sizes, 'dir': dirs},
+        index=pd.to_timedelta(times - times[0], unit='ms')
+    )
+
+    sent_bytes = df[df['dir'] == 1]['size'].sum()
+    received_bytes = df[df['dir'] == 2]['size'].sum()
+    sent_packets = len(df[df['dir'] == 1])
+    received_packets = len(df[df['dir'] == 2])
+
+    sent_large = df[(df['dir']==1) & (df['size'] > 1200)]
+    sent_small = df[(df['dir']==1) & (df['size'] < 200)]
+    received_large = df[(df['dir']==2) & (df['size'] > 1200)]
+    received_small = df[(df['dir']==2) & (df['size'] < 200)]
+
+    received_mean_size = df.loc[df.dir==2, 'size'].mean()
+    sent_mean_size = df.loc[df.dir==1, 'size'].mean()
+
+    df['ip_delay'] = df.index.to_series().diff().dt.total_seconds() * 1000
+    df = df.dropna(how='any')
+
+    df_rs = df.resample(resample_rate).sum()
+    f, Pxx_den = scipy.signal.welch(df_rs['size'].to_numpy(), fs = frequency)
+    peaks, _ = scipy.signal.find_peaks(np.sqrt(Pxx_den))
+    prominences = peak_prominences(np.sqrt(Pxx_den), peaks)[0]
+    max_prom = prominences.max() if len(prominences) else 0
+
+    def roll(seconds):
+        return df['ip_delay'].rolling(seconds).mean().mean()
+
+    def streak(dir):
+        longest = current = 0
+        for num in df['dir']:
+            current = current + 1 if num == dir else 0
+            longest = max(longest, current)
+        return longest
+
+    return [
+        sent_bytes / received_bytes,
+        sent_packets / received_packets,
+        roll(int(rolling_window_1/1000)),
+        roll(int(rolling_window_2/1000)),
+        received_mean_size,
+        sent_mean_size,
+        len(sent_large) / sent_packets,
+        len(sent_small) / sent_packets,
+        len(received_large) / received_packets,
+        len(received_small) / received_packets,
+        streak(1),
+        streak(2),
+        max_prom,
+    ]
+
+
+def random_chunks(n_chunks, seed=0):
+    """
+    Chunks of network-stats-like packets, with timestamp ties and long
+    same-direction streaks so that both are exercised.
+    """
+    rng = np.random.default_rng(seed)
+    chunks = []
+    while len(chunks) < n_chunks:
+        n = int(rng.integers(2, 400))
+        times = np.sort(rng.integers(0, 30000, n)).astype(np.int64)
+        sizes = rng.choice([60, 150, 700, 1300, 1460], n).astype(np.int64)
+        dirs = np.repeat(
+            rng.choice([1, 2], n), rng.integers(1, 6, n)
+        )[:n].astype(np.int8)
+        # The baseline can't handle chunks missing either direction
+        if (dirs == 1).any() and (dirs == 2).any():
+            chunks.append((times, sizes, dirs))
+    return chunks
+
+
+@pytest.mark.parametrize(
+    'rolling_window_1, rolling_window_2, resample_rate, frequency',
+    [
+        (5000, 5000, '100ms', 10),
+        (10000, 60000, '500ms', 2),
+        (5000, 20000, '250ms', 4),
+    ]
+)
+def test_matches_baseline(
+    rolling_window_1, rolling_window_2, resample_rate, frequency
+    ):
+    chunks = random_chunks(100)
+    resample_step = pd.Timedelta(resample_rate) // pd.Timedelta(1, unit='ms')
+
+    rows, signals = zip(*[
+        engineer_features(
+            times, sizes, dirs, 0, rolling_window_1, rolling_window_2,
+            resample_step
+        )
+        for times, sizes, dirs in chunks
+    ])
+    # Drop the label and append the prominence, as create_features does
+    features = np.column_stack([
+        np.array(rows)[:, :-1],
+        max_frequency_prominences(list(signals), frequency)
+    ])
+
+    expected = np.array([
+        baseline_features(
+            times, sizes, dirs, rolling_window_1, rolling_window_2,
+            resample_rate, frequency
+        )
+        for times, sizes, dirs in chunks
+    ])
+
+    np.testing.assert_allclose(features, expected, equal_nan=True)
+
+
+def write_preprocessed(path, times, sizes, dirs):
+    pd.DataFrame({
+        'time': np.asarray(times, dtype=np.int64),
+        'size': np.asarray(sizes, dtype=np.int64),
+        'dir': np.asarray(dirs, dtype=np.int8),
+    }).to_parquet(path, index=False)
+
+
+def baseline_chunks(times, sizes, dirs, chunk_size):
+    """
+    The original pd.cut/groupby chunking, as (start, stop) row bounds, keeping
+    only chunks with received bytes and at least two packets.
+    """
+    df = pd.DataFrame({'time': times, 'size': sizes, 'dir': dirs})
+    bins = np.arange(df['time'].values[0]-1, df['time'].values[-1]+chunk_size, chunk_size)
+    df['binned'] = pd.cut(df['time'], bins)
+    return [
+        (split_df.index[0], split_df.index[-1] + 1)
+        for _, split_df in df.groupby('binned')
+        if len(split_df) >= 2
+        and split_df.loc[split_df['dir'] == 2, 'size'].sum() > 0
+    ]
+
+
+def test_split_matches_pd_cut(tmp_path):
+    packets = [
+        # (time, size, dir) in bins of (999, 1999], (1999, 2999], ...
+        (1000, 100, 2), (1999, 100, 1),               # ends on a bin edge
+        (2000, 100, 2), (2999, 100, 2),               # received only
+        (3500, 100, 2),                               # a single packet
+                                                      # an empty bin
+        (5000, 100, 1), (5999, 100, 1),               # sent only
+        (6000, 0, 2), (6500, 100, 1),                 # no received bytes
+        (7000, 100, 2), (7001, 100, 1), (7999, 100, 2),
+    ]
+    times, sizes, dirs = map(np.array, zip(*packets))
+    filename = str(tmp_path / 'preprocessed-test-streaming-vpn.parquet')
+    write_preprocessed(filename, times, sizes, dirs)
+
+    label, (split_times, split_sizes, split_dirs), chunks = split(filename, 1000)
+
+    assert label == 1
+    np.testing.assert_array_equal(split_times, times)
+    np.testing.assert_array_equal(split_sizes, sizes)
+    np.testing.assert_array_equal(split_dirs, dirs)
+    assert chunks == [(0, 2), (2, 4), (9, 12)]
+    assert chunks == baseline_chunks(times, sizes, dirs, 1000)
+
+
+def test_create_features_matches_baseline(tmp_path):
+    chunk_size = 5000
+    params = (2000, 3000, '100ms', 10)
+    rng = np.random.default_rng(1)
+
+    expected = []
+    for name, label in [('test-streaming-vpn', 1), ('test-browsing-vpn', 0)]:
+        n = 3000
+        times = np.sort(rng.integers(0, 60000, n)) + 1604266754000
+        sizes = rng.choice([60, 150, 700, 1300, 1460], n)
+        dirs = rng.choice([1, 2], n)
+        write_preprocessed(
+            tmp_path / f'preprocessed-{name}.parquet', times, sizes, dirs
+        )
+        expected += [
+            baseline_features(
+                times[lo:hi], sizes[lo:hi], dirs[lo:hi], *params
+            ) + [label]
+            for lo, hi in baseline_chunks(times, sizes, dirs, chunk_size)
+        ]
+
+    create_features(
+        tmp_path, tmp_path, 'features.csv', chunk_size, *params
+    )
+
+    features = pd.read_csv(tmp_path / 'features.csv').to_numpy()
+    expected = np.array(expected)
+    expected = expected[~np.isnan(expected).any(axis=1)]
+
+    # Files are globbed in no particular order, so compare sorted rows
+    def sort_rows(arr):
+        return arr[np.lexsort(arr.T[::-1])]
+
+    assert features.shape == expected.shape
+    np.testing.assert_allclose(sort_rows(features), sort_rows(expected))
+
+
+@pytest.mark.parametrize('resample_rate', ['500us', '1500us', '0ms'])
+def test_rejects_sub_millisecond_resample_rate(tmp_path, resample_rate):
+    with pytest.raises(ValueError):
+        create_features(
+            tmp_path, tmp_path, 'features.csv', 60000, 5000, 5000,
+            resample_rate, 10
+        )